@@ -8,8 +8,8 @@ Hva denne skripten gjør:
 4) Sende personlige e‑poster via SendGrid (eller SMTP) med mal (Jinja2)
 5) Rate‑limit og logging, samt enkel «unsubscribe»-håndtering
 
-Avhengigheter:
-  pip install requests beautifulsoup4 lxml tldextract jinja2 python-dotenv sendgrid
+Avhengigheter (Python 3.10+, SQLite 3.35+):
+  pip install "httpx[http2]" selectolax tldextract jinja2 python-dotenv sendgrid
 
 Miljøvariabler:
   SENDGRID_API_KEY=...  (eller sett SMTP_* variabler hvis du bruker SMTP)
@@ -24,20 +24,31 @@ NB:
 - Send bare relevante henvendelser til bedriftsadresser i tråd med markedsføringsloven/GDPR.
 """
 from __future__ import annotations
+import argparse
+import asyncio
 import csv
 import os
 import re
 import sqlite3
 import time
 import random
+import itertools
 import json
+import logging
+import sys
+import tempfile
+from collections import defaultdict
 from dataclasses import dataclass, asdict
+from logging.handlers import RotatingFileHandler
 from typing import Iterable, List, Dict, Optional, Tuple
+from urllib.parse import unquote
 
-import requests
-from bs4 import BeautifulSoup
+import httpx
+from selectolax.lexbor import LexborHTMLParser
 import tldextract
 from jinja2 import Template
+from sendgrid import SendGridAPIClient
+from sendgrid.helpers.mail import Mail, From, To, ReplyTo
 
 # ---------------------------
 # Konfigurasjon
@@ -56,7 +67,36 @@ TARGET_NACE_PREFIXES = ["56"]  # 56 = Serveringsvirksomhet (restauranter, kantin
 REQUEST_TIMEOUT = 15
 CRAWL_DELAY = (1.0, 3.0)  # min, max sekunder mellom requests
 MAX_PAGES_PER_SITE = 3
-EMAIL_REGEX = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+MAX_PAGE_BYTES = 200_000  # kontaktinfo ligger nesten alltid i starten/footeren av små sider
+ENRICH_CONCURRENCY = 20   # maks samtidige sidekall under berikelse
+PER_HOST_CONCURRENCY = 2  # maks samtidige kall mot samme domene
+ENRICH_FLUSH_EVERY = 200  # antall funn per commit under berikelse
+ENRICH_PAGE_ROWS = 1000   # bedrifter lest fra databasen per runde under berikelse
+BRREG_CONCURRENCY = 4     # maks samtidige sidekall mot BRREG
+BRREG_PAGE_SIZE = 1000
+QUICK_PAGE_SIZE = 100     # «quick»: én liten side per kommune, som før
+BRREG_MAX_RESULTS = 10_000  # BRREG avviser sider der size * (page + 1) > 10 000
+HTTP_POOL_SIZE = 32       # maks åpne/keep-alive tilkoblinger i klientens pool
+HTTP_RETRIES = 3
+RETRY_BACKOFF = 0.5       # sekunder, dobles per forsøk
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Bytes-mønster med øvre grenser (RFC-lengder) for å begrense backtracking på sider med mange '@'.
+# Lookbehind: treff kan ikke starte midt i en lengre lokal del, eller rett etter en entity (&#106;ohn@ -> ikke "ohn@")
+EMAIL_REGEX = re.compile(rb"(?<![A-Za-z0-9._%+\-;])[A-Za-z0-9._%+\-]{1,64}@[A-Za-z0-9.\-]{1,253}\.[A-Za-z]{2,24}")
+CONTACT_PATHS = ("/", "/kontakt", "/om-oss", "/contact", "/about", "/kontakt-oss")
+PRIVATE_SUFFIXES = ("@gmail.com", "@outlook.com", "@hotmail.com", "@live.com", "@yahoo.com", "@icloud.com")
+PREFERRED_LOCAL = ("kontakt@", "post@", "info@", "booking@", "bestilling@")  # generiske kontaktadresser
+
+# Offentlig suffiksliste fra tldextract sitt innebygde snapshot (ingen nedlasting ved oppstart)
+TLD = tldextract.TLDExtract(
+    suffix_list_urls=(),
+    cache_dir=os.path.join(tempfile.gettempdir(), "tld_cache"),
+    include_psl_private_domains=False,
+)
+
+# Database
+EXPORT_FETCH_SIZE = 5000  # rader per fetchmany ved CSV-eksport
+UPSERT_BATCH_ROWS = 100   # 8 kolonner x 100 rader holder seg under SQLITE_MAX_VARIABLE_NUMBER (999)
 
 # Send-innstillinger
 SEND_RATE_SECONDS = (10, 25)  # delay mellom utsendelser
@@ -65,7 +105,7 @@ BATCH_LIMIT = 80              # maks antall e‑poster per kjøring
 # ---------------------------
 # Datastrukturer
 # ---------------------------
-@dataclass
+@dataclass(slots=True)
 class Company:
     orgnr: str
     name: str
@@ -75,20 +115,73 @@ class Company:
     email: Optional[str] = None
     source: str = "brreg"
 
+
+# Rad på vei til databasen, i samme feltrekkefølge som Company (jf. dataclasses.astuple).
+# Innhentingen bygger tupler direkte for å slippe ett objekt per bedrift.
+CompanyRow = Tuple[str, str, str, str, Optional[str], Optional[str], str]
+
 # ---------------------------
 # Verktøy
 # ---------------------------
 
+def _make_logger() -> logging.Logger:
+    # Én åpen filhandle for hele kjøringen i stedet for open/close per melding
+    logger = logging.getLogger("outreach")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    file_handler = RotatingFileHandler(LOG_PATH, maxBytes=10_000_000, backupCount=5, encoding="utf-8", delay=True)
+    file_handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S"))
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(file_handler)
+    logger.addHandler(console_handler)
+    return logger
+
+
+logger = _make_logger()
+
+
 def log(msg: str):
-    ts = time.strftime("%Y-%m-%d %H:%M:%S")
-    with open(LOG_PATH, "a", encoding="utf-8") as f:
-        f.write(f"[{ts}] {msg}\n")
-    print(msg)
+    logger.info(msg)
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+def http_client() -> httpx.AsyncClient:
+    # Én klient per kjøring: keep-alive og TLS-sesjoner gjenbrukes på tvers av kall
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=HTTP_RETRIES,  # kun tilkoblingsfeil; statuskoder håndteres i get_with_retry
+        limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE),
+    )
+    return httpx.AsyncClient(
+        transport=transport,
+        headers={"User-Agent": USER_AGENT},
+        timeout=REQUEST_TIMEOUT,
+        follow_redirects=True,
+    )
+
+
+async def get_with_retry(client: httpx.AsyncClient, url: str, stream: bool = False, **kwargs) -> httpx.Response:
+    # Med stream=True må kalleren selv lukke responsen (await r.aclose())
+    for attempt in range(HTTP_RETRIES + 1):
+        r = await client.send(client.build_request("GET", url, **kwargs), stream=stream)
+        if r.status_code not in RETRY_STATUSES or attempt == HTTP_RETRIES:
+            return r
+        await r.aclose()
+        await asyncio.sleep(RETRY_BACKOFF * (2 ** attempt))
 
 
 def init_db():
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
+    # WAL + synchronous=NORMAL: færre fsync per commit, lesere blokkerer ikke skriver
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-65536")  # ~64 MB
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS companies (
@@ -97,7 +190,7 @@ def init_db():
           municipality TEXT,
           nace TEXT,
           website TEXT,
-          email TEXT,
+          email TEXT CHECK (email = lower(email)),
           source TEXT,
           last_seen INTEGER
         )
@@ -106,7 +199,7 @@ def init_db():
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS sent (
-          email TEXT PRIMARY KEY,
+          email TEXT PRIMARY KEY CHECK (email = lower(email)),
           company_orgnr TEXT,
           sent_at INTEGER
         )
@@ -115,11 +208,20 @@ def init_db():
     cur.execute(
         """
         CREATE TABLE IF NOT EXISTS unsubscribed (
-          email TEXT PRIMARY KEY,
+          email TEXT PRIMARY KEY CHECK (email = lower(email)),
           unsubscribed_at INTEGER
         )
         """
     )
+    # E‑post lagres alltid normalisert (normalize_email), så spørringer kan bruke vanlige B-tree-indekser uten lower().
+    # CHECK-constraintene over gjelder kun nye databaser; eldre rader normaliseres her én gang.
+    if cur.execute("PRAGMA user_version").fetchone()[0] < 2:
+        cur.execute("UPDATE companies SET email = lower(trim(email)) WHERE email <> lower(trim(email))")
+        cur.execute("UPDATE OR IGNORE sent SET email = lower(trim(email)) WHERE email <> lower(trim(email))")
+        cur.execute("UPDATE OR IGNORE unsubscribed SET email = lower(trim(email)) WHERE email <> lower(trim(email))")
+        cur.execute("PRAGMA user_version = 2")
+    # sent.email og unsubscribed.email er PRIMARY KEY og har allerede indeks
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_companies_email ON companies(email) WHERE email IS NOT NULL")
     conn.commit()
     return conn
 
@@ -128,42 +230,71 @@ def init_db():
 # 1) Hent bedrifter fra BRREG
 # ---------------------------
 
-def fetch_from_brreg(municipality_numbers: List[str], nace_prefixes: List[str], max_pages: Optional[int] = None, verbose: bool = True) -> List[Company]:
-    headers = {"User-Agent": USER_AGENT, "Accept": "application/json"}
-    companies: List[Company] = []
+async def fetch_brreg_page(client: httpx.AsyncClient, muni: str, nace_prefixes: List[str], page: int, sem: asyncio.Semaphore, verbose: bool = True, page_size: int = BRREG_PAGE_SIZE) -> Optional[Dict]:
+    params = {
+        "kommunenummer": muni,
+        "size": page_size,
+        "page": page,
+        "sort": "navn,asc",
+    }
+    if nace_prefixes:
+        # Filtrer på serversiden; BRREG matcher også delkoder (56 -> 56.101, 56.210, ...)
+        params["naeringskode"] = ",".join(nace_prefixes)
+    async with sem:
+        if verbose:
+            log(f"BRREG GET page={page} muni={muni} params={params}")
+        try:
+            r = await get_with_retry(client, BRREG_BASE, params=params, headers={"Accept": "application/json"})
+            r.raise_for_status()
+            return r.json()
+        except Exception as e:
+            log(f"Error fetching BRREG page {page} for {muni}: {e}")
+            return None
+        finally:
+            await asyncio.sleep(random.uniform(*CRAWL_DELAY))
+
+
+async def fetch_from_brreg_async(client: httpx.AsyncClient, municipality_numbers: List[str], nace_prefixes: List[str], max_pages: Optional[int] = None, verbose: bool = True, page_size: int = BRREG_PAGE_SIZE) -> List[CompanyRow]:
+    sem = asyncio.Semaphore(BRREG_CONCURRENCY)
+    companies: List[CompanyRow] = []
 
     for muni in municipality_numbers:
-        page = 0
-        seen_page_signatures = set()
-        while True:
-            if max_pages is not None and page >= max_pages:
-                if verbose:
-                    log(f"Reached max_pages={max_pages} for {muni}")
-                break
-            params = {
-                "kommunenummer": muni,
-                "size": 100,
-                "page": page,
-                "sort": "navn,asc",
-            }
+        if max_pages is not None and max_pages <= 0:
             if verbose:
-                log(f"BRREG GET page={page} muni={muni} params={params}")
-            try:
-                r = requests.get(BRREG_BASE, params=params, headers=headers, timeout=REQUEST_TIMEOUT)
-                r.raise_for_status()
-                data = r.json()
-            except Exception as e:
-                log(f"Error fetching BRREG page {page} for {muni}: {e}")
-                break
-
+                log(f"Reached max_pages={max_pages} for {muni}")
+            continue
+        # Side 0 sekvensielt for å lese totalPages, resten parallelt
+        first = await fetch_brreg_page(client, muni, nace_prefixes, 0, sem, verbose, page_size)
+        if first is None:
+            continue
+        total_pages = (first.get("page") or {}).get("totalPages") or 1
+        last_page = total_pages
+        api_page_limit = BRREG_MAX_RESULTS // page_size
+        if max_pages is not None and max_pages < min(total_pages, api_page_limit):
+            last_page = max_pages
+            if verbose:
+                log(f"Reached max_pages={max_pages} for {muni}")
+        elif total_pages > api_page_limit:
+            # Sider utover grensen avvises med 400 av BRREG; ikke send dem
+            last_page = api_page_limit
+            log(f"BRREG returns at most {BRREG_MAX_RESULTS} results per query; fetching {api_page_limit} of {total_pages} pages for {muni} (results truncated)")
+        rest = await asyncio.gather(*[fetch_brreg_page(client, muni, nace_prefixes, p, sem, verbose, page_size) for p in range(1, last_page)])
+
+        prev_sig = None
+        failed_pages: List[int] = []
+        for page, data in enumerate([first, *rest]):
+            if data is None:
+                # Sidene er allerede hentet parallelt: hopp over den feilede og behold resten
+                failed_pages.append(page)
+                continue
             embedded = data.get("_embedded", {})
             enheter = embedded.get("enheter", [])
             # Safeguard: stop if the page repeats (some APIs can echo last page)
-            page_sig = tuple(sorted(e.get("organisasjonsnummer") for e in enheter))
-            if page_sig in seen_page_signatures:
+            page_sig = hash(frozenset(e.get("organisasjonsnummer") for e in enheter))
+            if page_sig == prev_sig:
                 log("Detected repeating page; stopping pagination to prevent infinite loop")
                 break
-            seen_page_signatures.add(page_sig)
+            prev_sig = page_sig
 
             if not enheter:
                 if verbose:
@@ -176,26 +307,25 @@ def fetch_from_brreg(municipality_numbers: List[str], nace_prefixes: List[str],
                 municipality = (e.get("forretningsadresse") or {}).get("kommunenummer", "")
                 nace = ((e.get("naeringskode1") or {}).get("kode", ""))
                 website = (e.get("hjemmeside") or "") or None
+                # BRREG treffer på næringskode 1–3; behold kun bedrifter der hovedkoden matcher
                 if nace_prefixes and nace and not any(nace.startswith(pref) for pref in nace_prefixes):
                     continue
-                companies.append(Company(orgnr=orgnr, name=name, municipality=municipality, nace=nace, website=website))
-            # Try to use API's own page info if available
-            total_pages = None
-            try:
-                page_info = data.get("page", {})
-                total_pages = page_info.get("totalPages")
-            except Exception:
-                total_pages = None
-
-            page += 1
-            if total_pages is not None and page >= total_pages:
-                if verbose:
-                    log(f"Reached last page per API (totalPages={total_pages}) for {muni}")
-                break
-            time.sleep(random.uniform(*CRAWL_DELAY))
+                companies.append((orgnr, name, municipality, nace, website, None, "brreg"))
+        else:
+            if verbose and last_page == total_pages:
+                log(f"Reached last page per API (totalPages={total_pages}) for {muni}")
+        if failed_pages:
+            log(f"Skipped {len(failed_pages)} BRREG page(s) for {muni} after errors: {failed_pages}")
     return companies
 
 
+def fetch_from_brreg(municipality_numbers: List[str], nace_prefixes: List[str], max_pages: Optional[int] = None, verbose: bool = True, page_size: int = BRREG_PAGE_SIZE) -> List[CompanyRow]:
+    async def run():
+        async with http_client() as client:
+            return await fetch_from_brreg_async(client, municipality_numbers, nace_prefixes, max_pages=max_pages, verbose=verbose, page_size=page_size)
+    return asyncio.run(run())
+
+
 # ---------------------------
 # 2) Finn e‑post fra nettsted
 # ---------------------------
@@ -212,73 +342,180 @@ def normalize_url(url: str) -> Optional[str]:
     return url.rstrip("/")
 
 
-def fetch(url: str) -> Optional[str]:
+async def fetch_async(client: httpx.AsyncClient, url: str) -> Optional[bytes]:
     try:
-        r = requests.get(url, headers={"User-Agent": USER_AGENT}, timeout=REQUEST_TIMEOUT)
-        if r.status_code >= 400:
-            return None
-        return r.text
+        # Les kun de første MAX_PAGE_BYTES (dekomprimert); resten av kroppen lastes aldri ned
+        r = await get_with_retry(client, url, stream=True)
+        try:
+            if r.status_code >= 400:
+                return None
+            body = bytearray()
+            async for chunk in r.aiter_bytes():
+                body += chunk
+                if len(body) >= MAX_PAGE_BYTES:
+                    break
+            return bytes(body[:MAX_PAGE_BYTES])
+        finally:
+            await r.aclose()
     except Exception:
         return None
 
 
-def extract_emails_from_html(html: str) -> List[str]:
-    if not html:
+def extract_emails_from_html(html: bytes) -> List[str]:
+    # De fleste sider har verken '@' eller mailto-lenker: hopp over regex og parsing helt
+    if not html or (b"@" not in html and b"mailto:" not in html):
         return []
-    emails = set(m.group(0).lower() for m in EMAIL_REGEX.finditer(html))
+    # Regex direkte på bytes (ingen dekoding); findall kjører løkken i C
+    emails = {m.lower().decode("ascii") for m in EMAIL_REGEX.findall(html)}
+    if b"mailto:" in html:
+        # DOM kun for mailto-lenker, som kan være %- eller entity-kodet og dermed usynlige for regex
+        tree = LexborHTMLParser(html)
+        for a in tree.css('a[href^="mailto:"]'):
+            addr = unquote((a.attributes.get("href") or "")[len("mailto:"):].split("?", 1)[0]).strip()
+            if EMAIL_REGEX.fullmatch(addr.encode()):
+                emails.add(addr.lower())
     # Filtrer åpenbart private domener
-    emails = {e for e in emails if not any(e.endswith(x) for x in ("@gmail.com", "@outlook.com", "@hotmail.com", "@live.com"))}
+    emails = {e for e in emails if not e.endswith(PRIVATE_SUFFIXES)}
     return sorted(emails)
 
 
-def candidate_contact_paths() -> List[str]:
-    return ["/", "/kontakt", "/om-oss", "/contact", "/about", "/kontakt-oss"]
-
-
-def crawl_for_email(website: str) -> Optional[str]:
+async def crawl_for_email_async(client: httpx.AsyncClient, website: str, sem: asyncio.Semaphore, host_sems: Dict[str, asyncio.Semaphore]) -> Optional[str]:
     base = normalize_url(website)
     if not base:
         return None
-    parts = tldextract.extract(base)
-    domain = ".".join(p for p in [parts.domain, parts.suffix] if p)
-
-    for path in candidate_contact_paths()[:MAX_PAGES_PER_SITE]:
-        html = fetch(base + path)
-        if not html:
-            continue
-        emails = [e for e in extract_emails_from_html(html) if e.endswith("@" + domain) or e.split("@")[-1].endswith(domain)]
-        if emails:
-            # Prioriter generiske kontaktadresser
-            preferred = sorted(emails, key=lambda e: (not any(k in e for k in ("kontakt@", "post@", "info@", "booking@", "bestilling@")), len(e)))
-            return preferred[0]
-        time.sleep(random.uniform(*CRAWL_DELAY))
-    return None
+    parts = TLD(base)
+    domain = ".".join(p for p in [parts.domain, parts.suffix] if p).lower()
+    domain_bytes = domain.encode()
+    # Delt per domene (kjeder deler ofte nettside), så samme vert aldri får mer enn PER_HOST_CONCURRENCY kall samtidig
+    host_sem = host_sems[domain]
+
+    async def fetch_polite(url: str) -> Optional[bytes]:
+        # Vent på domenet før en global plass tas, ellers kan en kjede med delt nettside
+        # binde opp alle plassene mens andre nettsteder står stille
+        async with host_sem:
+            async with sem:
+                html = await fetch_async(client, url)
+            # Hold domeneplassen (men ikke den globale) under ventetiden så raten mot verten holdes nede
+            await asyncio.sleep(random.uniform(*CRAWL_DELAY))
+            return html
+
+    # Alle kandidatsider parallelt, deretter én ekstraksjon over samlet innhold
+    pages = await asyncio.gather(*[fetch_polite(base + path) for path in CONTACT_PATHS[:MAX_PAGES_PER_SITE]])
+    html = b"\n".join(p for p in pages if p)
+    if not html:
+        return None
+    # Billig bytes-søk før regex: regex-treff krever domenet i klartekst (sammenlignet uten hensyn til store/små
+    # bokstaver). Sider med mailto-lenker går alltid videre, siden domenet der kan være %- eller entity-kodet.
+    if b"mailto:" not in html and domain_bytes not in html.lower():
+        return None
+    emails = [e for e in extract_emails_from_html(html) if e.endswith("@" + domain) or e.split("@")[-1].endswith(domain)]
+    if not emails:
+        return None
+    # Prioriter generiske kontaktadresser
+    preferred = sorted(emails, key=lambda e: (not any(k in e for k in PREFERRED_LOCAL), len(e)))
+    return preferred[0]
+
+
+async def enrich_async(conn, workers: int = ENRICH_CONCURRENCY) -> int:
+    TLD("example.no")  # last suffikslisten én gang før crawlingen starter
+    sem = asyncio.Semaphore(workers)
+    host_sems: Dict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(PER_HOST_CONCURRENCY))
+
+    async def crawl_row(orgnr: str, website: str) -> Tuple[str, Optional[str]]:
+        return orgnr, await crawl_for_email_async(client, website, sem, host_sems)
+
+    found: List[Tuple[str, str]] = []
+    count = 0
+    async with http_client() as client:
+        for todo in iter_companies_missing_email(conn):
+            # Skriv funn fortløpende i batcher i stedet for å vente på alle nettsteder
+            for fut in asyncio.as_completed([crawl_row(orgnr, website) for orgnr, website in todo]):
+                orgnr, email = await fut
+                if not email:
+                    continue
+                found.append((email, orgnr))
+                log(f"Found email {email} for orgnr {orgnr}")
+                if len(found) >= ENRICH_FLUSH_EVERY:
+                    count += update_emails(conn, found)
+                    found.clear()
+    count += update_emails(conn, found)
+    return count
 
 
 # ---------------------------
 # 3) Persistens og eksport
 # ---------------------------
 
-def upsert_companies(conn, companies: List[Company]):
-    cur = conn.cursor()
+def _upsert_companies_sql(n_rows: int) -> str:
+    values = ", ".join(["(?, ?, ?, ?, ?, ?, ?, ?)"] * n_rows)
+    return f"""
+        INSERT INTO companies (orgnr, name, municipality, nace, website, email, source, last_seen)
+        VALUES {values}
+        ON CONFLICT(orgnr) DO UPDATE SET
+          name=excluded.name,
+          municipality=excluded.municipality,
+          nace=excluded.nace,
+          website=COALESCE(excluded.website, companies.website),
+          email=COALESCE(excluded.email, companies.email),
+          source=excluded.source,
+          last_seen=excluded.last_seen
+        """
+
+
+def upsert_companies(conn, companies: Iterable[CompanyRow]):
     now = int(time.time())
-    for c in companies:
-        cur.execute(
-            """
-            INSERT INTO companies (orgnr, name, municipality, nace, website, email, source, last_seen)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(orgnr) DO UPDATE SET
-              name=excluded.name,
-              municipality=excluded.municipality,
-              nace=excluded.nace,
-              website=COALESCE(excluded.website, companies.website),
-              email=COALESCE(excluded.email, companies.email),
-              source=excluded.source,
-              last_seen=excluded.last_seen
-            """,
-            (c.orgnr, c.name, c.municipality, c.nace, c.website, c.email, c.source, now)
-        )
-    conn.commit()
+    rows = [
+        (orgnr, name, municipality, nace, website, normalize_email(email) if email else None, source, now)
+        for orgnr, name, municipality, nace, website, email, source in companies
+    ]
+    full_batch_sql = _upsert_companies_sql(UPSERT_BATCH_ROWS)
+    # Én transaksjon for hele batchen; flerrads-VALUES gir færre VM-kjøringer enn én INSERT per rad
+    with conn:
+        for i in range(0, len(rows), UPSERT_BATCH_ROWS):
+            batch = rows[i:i + UPSERT_BATCH_ROWS]
+            sql = full_batch_sql if len(batch) == UPSERT_BATCH_ROWS else _upsert_companies_sql(len(batch))
+            conn.execute(sql, list(itertools.chain.from_iterable(batch)))
+
+
+def iter_companies_missing_email(conn, page_size: int = ENRICH_PAGE_ROWS) -> Iterable[List[Tuple[str, str]]]:
+    # Keyset-paginering på rowid: ingen full fetchall, og rader som får e‑post underveis påvirker ikke sideinndelingen
+    last_rowid = 0
+    while True:
+        rows = conn.execute(
+            "SELECT rowid, orgnr, website FROM companies WHERE email IS NULL AND rowid > ? ORDER BY rowid LIMIT ?",
+            (last_rowid, page_size),
+        ).fetchall()
+        if not rows:
+            return
+        last_rowid = rows[-1][0]
+        yield [(orgnr, website) for _, orgnr, website in rows if website]
+
+
+def update_emails(conn, updates: List[Tuple[str, str]]) -> int:
+    # RETURNING gir antall faktisk oppdaterte rader uten egen SELECT; én commit for hele batchen
+    updated = 0
+    with conn:
+        for email, orgnr in updates:
+            row = conn.execute(
+                "UPDATE companies SET email=? WHERE orgnr=? AND email IS NULL RETURNING orgnr, email",
+                (normalize_email(email), orgnr),
+            ).fetchone()
+            if row is not None:
+                updated += 1
+    return updated
+
+
+def _write_rows(cur, writer) -> int:
+    # Strøm resultatet i biter så minnebruken er konstant uansett tabellstørrelse
+    cur.arraysize = EXPORT_FETCH_SIZE
+    count = 0
+    while True:
+        batch = cur.fetchmany()
+        if not batch:
+            break
+        writer.writerows(batch)
+        count += len(batch)
+    return count
 
 
 def export_csv(conn, path=CSV_PATH, include_without_email: bool = False):
@@ -287,23 +524,21 @@ def export_csv(conn, path=CSV_PATH, include_without_email: bool = False):
         cur.execute("SELECT orgnr, name, municipality, nace, website, email FROM companies")
     else:
         cur.execute("SELECT orgnr, name, municipality, nace, website, email FROM companies WHERE email IS NOT NULL")
-    rows = cur.fetchall()
     with open(path, "w", newline="", encoding="utf-8") as f:
         writer = csv.writer(f)
         writer.writerow(["orgnr", "name", "municipality", "nace", "website", "email"])
-        writer.writerows(rows)
-    log(f"Exported {len(rows)} rows to {path}")
+        count = _write_rows(cur, writer)
+    log(f"Exported {count} rows to {path}")
 
 
 def export_names(conn, path="outreach_companies_names.csv"):
     cur = conn.cursor()
     cur.execute("SELECT orgnr, name, municipality, nace, website FROM companies ORDER BY name ASC")
-    rows = cur.fetchall()
     with open(path, "w", newline="", encoding="utf-8") as f:
         writer = csv.writer(f)
         writer.writerow(["orgnr", "name", "municipality", "nace", "website"])
-        writer.writerows(rows)
-    log(f"Exported {len(rows)} names to {path}")
+        count = _write_rows(cur, writer)
+    log(f"Exported {count} names to {path}")
 
 
 # ---------------------------
@@ -314,10 +549,18 @@ def render_template(template_str: str, context: Dict[str, str]) -> str:
     return Template(template_str).render(**context)
 
 
-def send_via_sendgrid(to_email: str, subject: str, html_body: str, from_name: str, from_email: str, reply_to: Optional[str] = None):
-    from sendgrid import SendGridAPIClient
-    from sendgrid.helpers.mail import Mail, From, To, ReplyTo, Content
+_SG: Optional[SendGridAPIClient] = None
+
+
+def _sg() -> SendGridAPIClient:
+    # Én klient for hele kampanjen i stedet for en ny per e‑post
+    global _SG
+    if _SG is None:
+        _SG = SendGridAPIClient(api_key=os.environ.get("SENDGRID_API_KEY"))
+    return _SG
 
+
+def send_via_sendgrid(to_email: str, subject: str, html_body: str, from_name: str, from_email: str, reply_to: Optional[str] = None):
     message = Mail(
         from_email=From(from_email, from_name),
         to_emails=[To(to_email)],
@@ -327,22 +570,20 @@ def send_via_sendgrid(to_email: str, subject: str, html_body: str, from_name: st
     if reply_to:
         message.reply_to = ReplyTo(reply_to)
 
-    sg = SendGridAPIClient(api_key=os.environ.get("SENDGRID_API_KEY"))
-    resp = sg.send(message)
+    resp = _sg().send(message)
     if resp.status_code >= 300:
         raise RuntimeError(f"SendGrid error: {resp.status_code} {resp.body}")
 
 
-def already_unsubscribed(conn, email: str) -> bool:
+def mark_sent(conn, email: str, orgnr: str) -> int:
     cur = conn.cursor()
-    cur.execute("SELECT 1 FROM unsubscribed WHERE email=?", (email.lower(),))
-    return cur.fetchone() is not None
-
-
-def mark_sent(conn, email: str, orgnr: str):
-    cur = conn.cursor()
-    cur.execute("INSERT OR REPLACE INTO sent (email, company_orgnr, sent_at) VALUES (?, ?, ?)", (email.lower(), orgnr, int(time.time())))
+    cur.execute(
+        "INSERT OR REPLACE INTO sent (email, company_orgnr, sent_at) VALUES (?, ?, ?) RETURNING sent_at",
+        (normalize_email(email), orgnr, int(time.time())),
+    )
+    (sent_at,) = cur.fetchone()
     conn.commit()
+    return sent_at
 
 
 def send_campaign(conn, subject: str, body_template: str, limit=BATCH_LIMIT):
@@ -351,13 +592,15 @@ def send_campaign(conn, subject: str, body_template: str, limit=BATCH_LIMIT):
     reply_to = os.getenv("OUTREACH_REPLY_TO", from_email)
 
     cur = conn.cursor()
-    # Velg kandidater med e‑post, som ikke er sendt og ikke er unsubscribed
+    # Velg kandidater med e‑post, som ikke er sendt og ikke er unsubscribed. Begge filtrene ligger i SQL
+    # (via primærnøkkel-indeksene) før LIMIT, så avmeldte rader aldri fortrenger sendbare kandidater.
     cur.execute(
         """
         SELECT c.orgnr, c.name, c.municipality, c.website, c.email
         FROM companies c
-        LEFT JOIN sent s ON lower(c.email) = lower(s.email)
-        WHERE c.email IS NOT NULL AND s.email IS NULL
+        WHERE c.email IS NOT NULL
+          AND c.email NOT IN (SELECT email FROM sent)
+          AND c.email NOT IN (SELECT email FROM unsubscribed)
         LIMIT ?
         """,
         (limit,)
@@ -365,8 +608,6 @@ def send_campaign(conn, subject: str, body_template: str, limit=BATCH_LIMIT):
     rows = cur.fetchall()
 
     for orgnr, name, municipality, website, email in rows:
-        if already_unsubscribed(conn, email):
-            continue
         context = {
             "company_name": name,
             "municipality": municipality,
@@ -376,8 +617,8 @@ def send_campaign(conn, subject: str, body_template: str, limit=BATCH_LIMIT):
         html_body = render_template(body_template, context)
         try:
             send_via_sendgrid(email, subject, html_body, from_name, from_email, reply_to)
-            mark_sent(conn, email, orgnr)
-            log(f"SENT to {email} ({name})")
+            sent_at = mark_sent(conn, email, orgnr)
+            log(f"SENT to {email} ({name}) at {sent_at}")
         except Exception as e:
             log(f"ERROR sending to {email}: {e}")
         time.sleep(random.uniform(*SEND_RATE_SECONDS))
@@ -401,14 +642,24 @@ Din Bedrift Catering</p>
 """
 
 
+def positive_int(value: str) -> int:
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"må være et positivt heltall, fikk {value!r}")
+    return n
+
+
 def main():
-    import argparse
     parser = argparse.ArgumentParser(description="Local B2B outreach pipeline (NO)")
     parser.add_argument("action", choices=["fetch", "enrich", "export", "export-names", "send", "quick"], help="Hva skal gjøres")
     parser.add_argument("--municipalities", nargs="*", default=DEFAULT_MUNICIPALITY_NUMBERS, help="Kommunenummer, f.eks. 0301 for Oslo")
     parser.add_argument("--nace", nargs="*", default=TARGET_NACE_PREFIXES, help="NACE-prefiks, f.eks. 56 for servering")
-    parser.add_argument("--max-pages", type=int, default=None, help="Maks antall sider å hente per kommune (for rask test)")
+    parser.add_argument("--max-pages", type=int, default=None, help=f"Maks antall sider å hente per kommune, à {BRREG_PAGE_SIZE} bedrifter (for rask test)")
     parser.add_argument("--quiet", action="store_true", help="Mindre logging")
+    parser.add_argument("--workers", type=positive_int, default=ENRICH_CONCURRENCY, help="Maks samtidige sidekall ved enrich")
     parser.add_argument("--subject", default="Lunsj og møtemat levert lokalt")
     parser.add_argument("--template_path", default=None, help="HTML-mal (Jinja2). Hvis ikke satt, brukes DEFAULT_TEMPLATE")
     args = parser.parse_args()
@@ -422,27 +673,13 @@ def main():
 
     elif args.action == "quick":
         # Quick test: fetch a single page and immediately export CSV
-        comps = fetch_from_brreg(args.municipalities, args.nace, max_pages=1, verbose=not args.quiet)
+        comps = fetch_from_brreg(args.municipalities, args.nace, max_pages=1, verbose=not args.quiet, page_size=QUICK_PAGE_SIZE)
         upsert_companies(conn, comps)
         export_csv(conn)
         log("Quick run complete (1 page per kommune).")
 
     elif args.action == "enrich":
-
-        cur = conn.cursor()
-        cur.execute("SELECT orgnr, website FROM companies WHERE email IS NULL")
-        todo = cur.fetchall()
-        count = 0
-        for orgnr, website in todo:
-            if not website:
-                continue
-            email = crawl_for_email(website)
-            if email:
-                cur.execute("UPDATE companies SET email=? WHERE orgnr=?", (email, orgnr))
-                conn.commit()
-                count += 1
-                log(f"Found email {email} for orgnr {orgnr}")
-                time.sleep(random.uniform(*CRAWL_DELAY))
+        count = asyncio.run(enrich_async(conn, workers=args.workers))
         log(f"Enriched {count} companies with email")
 
     elif args.action == "export":
@@ -0,0 +1,14 @@
+from b2b_outreach_pipeline import extract_emails_from_html
+
+
+def test_extract_emails_plain_text():
+    assert extract_emails_from_html(b"<p>Kontakt: Post@Firma.NO</p>") == ["post@firma.no"]
+
+
+def test_extract_emails_entity_encoded_mailto_has_no_truncated_tail():
+    html = b'<a href="mailto:&#106;ohn@firma.no">Skriv til oss</a>'
+    assert extract_emails_from_html(html) == ["john@firma.no"]
+
+
+def test_extract_emails_ignores_overlong_local_part():
+    assert extract_emails_from_html(b"x" * 70 + b"@firma.no") == []